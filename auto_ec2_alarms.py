@@ -1,9 +1,14 @@
 import boto3
 from botocore.config import Config
-from concurrent.futures import ThreadPoolExecutor
-from typing import List, Dict
+from botocore.exceptions import ClientError
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Optional
 from datetime import datetime
+from functools import lru_cache
+import atexit
 import logging
+import logging.handlers
+import queue
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -22,91 +27,161 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(formatter)
 stream_handler.setFormatter(formatter)
 
-# Add both handlers to the logger
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+# Worker threads only enqueue records; a background listener owns the file and console I/O
+log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+queue_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+queue_listener.start()
 
-# Configure boto3 with retries and timeouts
+# Flush pending records on exit
+atexit.register(queue_listener.stop)
+
+# Number of worker threads creating alarms concurrently; kept below max_pool_connections
+MAX_WORKERS = 20
+
+# Configure boto3 with adaptive retries, timeouts, TCP keep-alive and a connection pool wide enough for the worker threads
 boto3_config = Config(
     retries=dict(
-        max_attempts=3,
-        mode='standard'
+        max_attempts=10,
+        mode='adaptive'
     ),
     connect_timeout=5,
-    read_timeout=10
+    read_timeout=10,
+    max_pool_connections=50,
+    tcp_keepalive=True
 )
 
-def get_sns_topic_arn(topic_name: str, region: str) -> str:
-    """Get SNS topic ARN with pagination support."""
+# Fields shared by every alarm, regardless of instance or metric
+BASE_ALARM = {
+    'ActionsEnabled': True,
+    'Statistic': 'Average',
+    'Period': 60,
+    'EvaluationPeriods': 5,
+    'TreatMissingData': 'breaching'
+}
+
+# Linux CWAgent metrics that get an alarm, mapped to their alarm name suffix
+LINUX_CWAGENT_ALARMS = {
+    'mem_used_percent': 'mem-used',
+    'disk_used_percent': 'disk-used'
+}
+
+# Maximum number of ARNs accepted by a single TagResources call
+TAG_RESOURCES_BATCH_SIZE = 20
+
+# Error codes that mean the request was throttled even after botocore's retries
+THROTTLING_ERROR_CODES = {'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException'}
+
+@lru_cache(maxsize=None)
+def get_sns_topic_arn(topic_name: str, region: str, account_id: str, partition: str) -> str:
+    """Get SNS topic ARN by checking the topic exists, cached per (topic_name, region, account_id, partition)."""
     sns_client = boto3.client('sns', region_name=region, config=boto3_config)
-    paginator = sns_client.get_paginator('list_topics')
+    topic_arn = f"arn:{partition}:sns:{region}:{account_id}:{topic_name}"
 
     try:
-        for page in paginator.paginate():
-            for topic in page.get('Topics', []):
-                if topic_name in topic['TopicArn']:
-                    return topic['TopicArn']
-        raise ValueError(f"Topic '{topic_name}' not found in region {region}")
-    except Exception as e:
+        sns_client.get_topic_attributes(TopicArn=topic_arn)
+        return topic_arn
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NotFound', 'NotFoundException'):
+            error = ValueError(f"Topic '{topic_name}' not found in region {region}")
+            logger.error(f"Error finding SNS topic: {str(error)}")
+            raise error from e
         logger.error(f"Error finding SNS topic: {str(e)}")
         raise
 
-def tag_alarm(cloudwatch_client, alarm_name: str, tags: List[Dict[str, str]]) -> None:
-    """Add tags to a CloudWatch alarm."""
+def tag_alarms(tagging_client, alarm_arns: List[str], tags: Dict[str, str]) -> None:
+    """Add tags to CloudWatch alarms in chunks of up to 20 ARNs per call."""
+    for i in range(0, len(alarm_arns), TAG_RESOURCES_BATCH_SIZE):
+        chunk = alarm_arns[i:i + TAG_RESOURCES_BATCH_SIZE]
+        try:
+            response = tagging_client.tag_resources(ResourceARNList=chunk, Tags=tags)
+            failed = response.get('FailedResourcesMap', {})
+            for alarm_arn, failure in failed.items():
+                logger.error(f"Failed to tag alarm {alarm_arn}: {failure.get('ErrorMessage')}")
+            logger.info(f"Tags added to {len(chunk) - len(failed)} alarms: {tags}")
+        except Exception as e:
+            logger.error(f"Failed to tag alarms {chunk}: {str(e)}")
+
+def create_cloudwatch_alarm(cloudwatch_client, alarm_config: Dict) -> Optional[str]:
+    """Create a single CloudWatch alarm and return its name, or None if it failed."""
     try:
-        cloudwatch_client.tag_resource(
-            ResourceARN=f"arn:aws:cloudwatch:{cloudwatch_client.meta.region_name}:{boto3.client('sts').get_caller_identity()['Account']}:alarm:{alarm_name}",
-            Tags=tags
-        )
-        logger.info(f"Tags added to alarm {alarm_name}: {tags}")
+        cloudwatch_client.put_metric_alarm(**alarm_config)
+        logger.info(f"Successfully created alarm: {alarm_config['AlarmName']}")
+        return alarm_config['AlarmName']
+    except ClientError as e:
+        if e.response['Error']['Code'] in THROTTLING_ERROR_CODES:
+            raise
+        logger.error(f"Error creating alarm {alarm_config['AlarmName']}: {str(e)}")
+        return None
     except Exception as e:
-        logger.error(f"Failed to tag alarm {alarm_name}: {str(e)}")
+        logger.error(f"Error creating alarm {alarm_config['AlarmName']}: {str(e)}")
+        return None
 
-def create_cloudwatch_alarm_batch(cloudwatch_client, alarms_config: List[Dict]) -> None:
-    """Create multiple CloudWatch alarms individually and tag them."""
-    for alarm_config in alarms_config:
-        try:
-            # Create each alarm individually
-            cloudwatch_client.put_metric_alarm(**alarm_config)
-            logger.info(f"Successfully created alarm: {alarm_config['AlarmName']}")
-
-            # Add tags to the alarm
-            tag_alarm(
-                cloudwatch_client,
-                alarm_config['AlarmName'],
-                tags=[
-                    {'Key': alarm_tag, 'Value': datetime.utcnow().strftime('%Y-%m-%d')}
-                ]
-            )
-        except Exception as e:
-            logger.error(f"Error creating or tagging alarm {alarm_config['AlarmName']}: {str(e)}")
+def create_cloudwatch_alarm_batch(executor: ThreadPoolExecutor, cloudwatch_client, alarms_config: List[Dict]) -> List[Future]:
+    """Submit multiple CloudWatch alarms for concurrent creation."""
+    # PutMetricAlarm has no bulk variant, so each alarm is created as its own task
+    return [
+        executor.submit(create_cloudwatch_alarm, cloudwatch_client, alarm_config)
+        for alarm_config in alarms_config
+    ]
+
+def get_cwagent_metrics_by_instance(cloudwatch_client) -> Dict[str, List[Dict]]:
+    """List the CWAgent metrics used for Linux alarms once and index them by InstanceId."""
+    metrics_by_instance = {}
+    paginator = cloudwatch_client.get_paginator('list_metrics')
+
+    # Only scan the metrics that get an alarm, not the whole CWAgent namespace
+    for metric_name in LINUX_CWAGENT_ALARMS:
+        for page in paginator.paginate(Namespace='CWAgent', MetricName=metric_name):
+            for metric in page.get('Metrics', []):
+                for dimension in metric['Dimensions']:
+                    if dimension['Name'] == 'InstanceId':
+                        metrics_by_instance.setdefault(dimension['Value'], []).append(metric)
+                        break
 
-def process_instance(instance: Dict, account_alias: str, sns_topic_arn: str, region: str) -> List[Dict]:
+    return metrics_by_instance
+
+def get_existing_alarms(cloudwatch_client, alarm_prefix: str) -> Dict[str, Dict]:
+    """List existing alarms that start with alarm_prefix, indexed by AlarmName."""
+    existing_alarms = {}
+    paginator = cloudwatch_client.get_paginator('describe_alarms')
+
+    for page in paginator.paginate(AlarmNamePrefix=f"{alarm_prefix}_"):
+        for alarm in page.get('MetricAlarms', []):
+            existing_alarms[alarm['AlarmName']] = alarm
+
+    return existing_alarms
+
+def is_alarm_unchanged(existing_alarm: Dict, alarm_config: Dict) -> bool:
+    """Check whether an existing alarm already matches every submitted field."""
+    for key, value in alarm_config.items():
+        existing_value = existing_alarm.get(key)
+        if key == 'Dimensions':
+            # CloudWatch does not preserve dimension order
+            value = sorted((dimension['Name'], dimension['Value']) for dimension in value)
+            existing_value = sorted((dimension['Name'], dimension['Value']) for dimension in existing_value or [])
+        if existing_value != value:
+            return False
+    return True
+
+def process_instance(instance: Dict, account_alias: str, base_alarm: Dict, metrics_by_instance: Dict[str, List[Dict]], alarm_prefix: str) -> List[Dict]:
     """Process a single EC2 instance and return its alarm configurations."""
     instance_id = instance['InstanceId']
     instance_type = instance['InstanceType']
-    instance_name = next((tag['Value'] for tag in instance.get('Tags', []) 
-                         if tag['Key'] == 'Name'), 'UnnamedInstance')
+    tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', ())}
+    instance_name = tags.get('Name', 'UnnamedInstance')
     image_id = instance.get('ImageId', 'UnknownImage')
     
     # Identify SO
     platform = instance.get('Platform', 'linux').lower()  # Return 'windows' or 'linux'.
     
     alarm_configs = []
-    base_alarm = {
-        'ActionsEnabled': True,
-        'AlarmActions': [sns_topic_arn],
-        'OKActions': [sns_topic_arn],
-        'Statistic': 'Average',
-        'Period': 60,
-        'EvaluationPeriods': 5,
-        'TreatMissingData': 'breaching'
-    }
+    name_prefix = f"{alarm_prefix}_{account_alias}_ec2_{instance_name}_"
 
     # Status Check Alarm
     alarm_configs.append({
         **base_alarm,
-        'AlarmName': f"{alarm_prefix}_{account_alias}_ec2_{instance_name}_status-check",
+        'AlarmName': name_prefix + "status-check",
         'MetricName': 'StatusCheckFailed',
         'Namespace': 'AWS/EC2',
         'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}],
@@ -117,7 +192,7 @@ def process_instance(instance: Dict, account_alias: str, sns_topic_arn: str, reg
     # CPU Utilization Alarm
     alarm_configs.append({
         **base_alarm,
-        'AlarmName': f"{alarm_prefix}_{account_alias}_ec2_{instance_name}_cpu-used",
+        'AlarmName': name_prefix + "cpu-used",
         'MetricName': 'CPUUtilization',
         'Namespace': 'AWS/EC2',
         'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}],
@@ -127,47 +202,36 @@ def process_instance(instance: Dict, account_alias: str, sns_topic_arn: str, reg
 
     # Add alarms for Linux (CWAgent)
     if platform == 'linux':
-        metrics_client = boto3.client('cloudwatch', region_name=region, config=boto3_config)
-        metrics = metrics_client.list_metrics(
-            Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-            Namespace='CWAgent'
-        )
-        metrics_available = metrics.get('Metrics', [])
-
-        for metric in metrics_available:
+        for metric in metrics_by_instance.get(instance_id, []):
             metric_name = metric['MetricName']
-            dimensions = metric['Dimensions']
+            alarm_suffix = LINUX_CWAGENT_ALARMS.get(metric_name)
+            if alarm_suffix is None:
+                continue
 
-            if metric_name == 'mem_used_percent':
-                alarm_configs.append({
-                    **base_alarm,
-                    'AlarmName': f"{alarm_prefix}_{account_alias}_ec2_{instance_name}_mem-used",
-                    'MetricName': metric_name,
-                    'Namespace': 'CWAgent',
-                    'Dimensions': dimensions,
-                    'Threshold': 95,
-                    'ComparisonOperator': 'GreaterThanOrEqualToThreshold'
-                })
+            dimensions = metric['Dimensions']
 
+            # Disk alarm only for the root filesystem
             if metric_name == 'disk_used_percent':
-                for dimension in dimensions:
-                    if dimension['Name'] == 'path' and dimension['Value'] == '/':
-                        alarm_configs.append({
-                            **base_alarm,
-                            'AlarmName': f"{alarm_prefix}_{account_alias}_ec2_{instance_name}_disk-used",
-                            'MetricName': metric_name,
-                            'Namespace': 'CWAgent',
-                            'Dimensions': dimensions,
-                            'Threshold': 95,
-                            'ComparisonOperator': 'GreaterThanOrEqualToThreshold'
-                        })
+                dims = {dimension['Name']: dimension['Value'] for dimension in dimensions}
+                if dims.get('path') != '/':
+                    continue
+
+            alarm_configs.append({
+                **base_alarm,
+                'AlarmName': name_prefix + alarm_suffix,
+                'MetricName': metric_name,
+                'Namespace': 'CWAgent',
+                'Dimensions': dimensions,
+                'Threshold': 95,
+                'ComparisonOperator': 'GreaterThanOrEqualToThreshold'
+            })
 
     # Add alarms for Windows
     elif platform == 'windows':
         # Mem alarm for Windows
         alarm_configs.append({
             **base_alarm,
-            'AlarmName': f"{alarm_prefix}_{account_alias}_ec2_{instance_name}_mem-used",
+            'AlarmName': name_prefix + "mem-used",
             'MetricName': 'Memory % Committed Bytes In Use',
             'Namespace': 'CWAgent',
             'Dimensions': [
@@ -183,7 +247,7 @@ def process_instance(instance: Dict, account_alias: str, sns_topic_arn: str, reg
         # Disk Alarm for Windows (C:)
         alarm_configs.append({
             **base_alarm,
-            'AlarmName': f"{alarm_prefix}_{account_alias}_ec2_{instance_name}_disk-used",
+            'AlarmName': name_prefix + "disk-used",
             'MetricName': 'LogicalDisk % Free Space',
             'Namespace': 'CWAgent',
             'Dimensions': [
@@ -199,72 +263,131 @@ def process_instance(instance: Dict, account_alias: str, sns_topic_arn: str, reg
 
     return alarm_configs
 
-def create_ec2_alarms(region: str, sns_topic_name: str, instance_ids: List[str], instance_tag_name: str, instance_tag_value: str) -> None:
+def create_ec2_alarms(region: str, sns_topic_name: str, instance_ids: List[str], instance_tag_name: str, instance_tag_value: str, alarm_prefix: str, alarm_tag: str, force: bool = False) -> None:
     """Create EC2 alarms with optimized batch processing."""
+    # Validate that either instance_ids or instance_tag_name and instance_tag_value is provided
+    if not instance_ids and (not instance_tag_name or not instance_tag_value):
+        raise ValueError("You must provide either instance_ids or both instance_tag_name and instance_tag_value.")
+
     session = boto3.Session(region_name=region)
     ec2_client = session.client('ec2', config=boto3_config)
     cloudwatch_client = session.client('cloudwatch', config=boto3_config)
     iam_client = session.client('iam', config=boto3_config)
+    sts_client = session.client('sts', config=boto3_config)
+    tagging_client = session.client('resourcegroupstaggingapi', config=boto3_config)
+
+    # Resolve account ID, partition and region once; they are invariant for the whole run
+    caller_identity = sts_client.get_caller_identity()
+    account_id = caller_identity['Account']
+    partition = caller_identity['Arn'].split(':')[1]
+    cloudwatch_region = cloudwatch_client.meta.region_name
 
     # Get account alias
     account_alias = iam_client.list_account_aliases().get('AccountAliases', ['default-account'])[0]
 
     # Get SNS topic ARN
-    sns_topic_arn = get_sns_topic_arn(sns_topic_name, region)
+    sns_topic_arn = get_sns_topic_arn(sns_topic_name, region, account_id, partition)
+    base_alarm = {
+        **BASE_ALARM,
+        'AlarmActions': [sns_topic_arn],
+        'OKActions': [sns_topic_arn]
+    }
 
-    # Get instance details in batches
-    paginator = ec2_client.get_paginator('describe_instances')
-    all_alarm_configs = []
+    # Get the Linux CWAgent metrics for every instance with one paginated scan per metric name
+    metrics_by_instance = get_cwagent_metrics_by_instance(cloudwatch_client)
 
-    # Validate that either instance_ids or instance_tag_name and instance_tag_value is provided
-    if not instance_ids and (not instance_tag_name or not instance_tag_value):
-        raise ValueError("You must provide either instance_ids or both instance_tag_name and instance_tag_value.")
+    # Only running instances are worth alarming on
+    filters = [{'Name': 'instance-state-name', 'Values': ['running']}]
 
     # If no specific instance IDs are provided, filter by the tag instance_tag_name: instance_tag_value
     if not instance_ids:
-        filters = [{'Name': f'tag:{instance_tag_name}', 'Values': [instance_tag_value]}]
-        paginator = ec2_client.get_paginator('describe_instances')
-        for page in paginator.paginate(Filters=filters):
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                futures = []
-                for reservation in page['Reservations']:
-                    for instance in reservation['Instances']:
-                        futures.append(
-                            executor.submit(
-                                process_instance,
-                                instance,
-                                account_alias,
-                                sns_topic_arn,
-                                region
-                            )
-                        )
-
-                for future in futures:
-                    all_alarm_configs.extend(future.result())
+        filters.append({'Name': f'tag:{instance_tag_name}', 'Values': [instance_tag_value]})
+        paginate_kwargs = {'Filters': filters}
     else:
-        for page in paginator.paginate(InstanceIds=instance_ids):
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                futures = []
+        paginate_kwargs = {'Filters': filters, 'InstanceIds': instance_ids}
+
+    # Unless forced, skip alarms that already exist with the same configuration
+    existing_alarms = {} if force else get_existing_alarms(cloudwatch_client, alarm_prefix)
+
+    # Alarm names submitted in this run, mapped to the instance that claimed them
+    submitted_alarm_names = {}
+
+    # Get instance details in batches
+    paginator = ec2_client.get_paginator('describe_instances')
+    alarm_futures = []
+    described_instance_ids = set()
+
+    alarm_arn_prefix = f"arn:{partition}:cloudwatch:{cloudwatch_region}:{account_id}:alarm:"
+    throttling_error = None
+
+    try:
+        # Building alarm configs is an in-memory lookup, so each page's alarms are submitted for
+        # creation before the next describe_instances page is fetched
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for page in paginator.paginate(**paginate_kwargs):
                 for reservation in page['Reservations']:
                     for instance in reservation['Instances']:
-                        futures.append(
-                            executor.submit(
-                                process_instance,
+                        described_instance_ids.add(instance['InstanceId'])
+                        try:
+                            alarm_configs = process_instance(
                                 instance,
                                 account_alias,
-                                sns_topic_arn,
-                                region
+                                base_alarm,
+                                metrics_by_instance,
+                                alarm_prefix
                             )
-                        )
+                        except Exception as e:
+                            logger.error(f"Error processing instance {instance['InstanceId']}: {str(e)}")
+                            continue
+
+                        pending_alarm_configs = []
+                        for alarm_config in alarm_configs:
+                            alarm_name = alarm_config['AlarmName']
+                            if alarm_name in submitted_alarm_names:
+                                if submitted_alarm_names[alarm_name] == instance['InstanceId']:
+                                    logger.warning(
+                                        f"Skipping alarm {alarm_name} for instance {instance['InstanceId']}: "
+                                        f"the instance publishes more than one {alarm_config['MetricName']} series"
+                                    )
+                                else:
+                                    logger.warning(
+                                        f"Skipping alarm {alarm_name} for instance {instance['InstanceId']}: "
+                                        f"name already used by instance {submitted_alarm_names[alarm_name]}"
+                                    )
+                                continue
+                            submitted_alarm_names[alarm_name] = instance['InstanceId']
+                            if alarm_name in existing_alarms and is_alarm_unchanged(existing_alarms[alarm_name], alarm_config):
+                                logger.info(f"Skipping unchanged alarm: {alarm_name}")
+                                continue
+                            pending_alarm_configs.append(alarm_config)
+
+                        alarm_futures.extend(create_cloudwatch_alarm_batch(executor, cloudwatch_client, pending_alarm_configs))
+
+        # Explicitly requested instances that are not running were dropped by the state filter
+        for instance_id in instance_ids:
+            if instance_id not in described_instance_ids:
+                logger.warning(f"Skipping instance {instance_id}: it is not in the running state")
+    finally:
+        # Tag every alarm that was created successfully in bulk, even if describe_instances failed part-way
+        created_arns = []
+        for future in alarm_futures:
+            try:
+                alarm_name = future.result()
+            except ClientError as e:
+                logger.error(f"Alarm creation throttled: {str(e)}")
+                throttling_error = throttling_error or e
+                continue
+            except Exception as e:
+                logger.error(f"Error creating alarm: {str(e)}")
+                continue
+            if alarm_name:
+                created_arns.append(alarm_arn_prefix + alarm_name)
 
-                for future in futures:
-                    all_alarm_configs.extend(future.result())
+        tag_alarms(tagging_client, created_arns, {alarm_tag: datetime.utcnow().strftime('%Y-%m-%d')})
 
-    # Create alarms in batches of 10
-    batch_size = 10
-    for i in range(0, len(all_alarm_configs), batch_size):
-        batch = all_alarm_configs[i:i + batch_size]
-        create_cloudwatch_alarm_batch(cloudwatch_client, batch)
+    # Fail the run rather than silently dropping alarms that were still throttled after retries
+    if throttling_error:
+        raise throttling_error
 
 if __name__ == "__main__":
     region = "us-east-1"  # Replace with your AWS region
@@ -274,9 +397,10 @@ if __name__ == "__main__":
     alarm_prefix = "gl" # Replace with your Prefix for alarm
     instance_tag_name = "gl_env"  # Replace with your tag name (e.g. gl_env)
     instance_tag_value = "prod"  # Replace with your tag value (e.g. prod)
+    force = False  # Set to True to resubmit alarms that already exist unchanged
 
     try:
-        create_ec2_alarms(region, sns_topic_name, instance_ids, instance_tag_name, instance_tag_value)
+        create_ec2_alarms(region, sns_topic_name, instance_ids, instance_tag_name, instance_tag_value, alarm_prefix, alarm_tag, force)
         logger.info("Alarms created successfully.")
     except Exception as e:
         logger.error(f"Error creating alarms: {str(e)}")
\ No newline at end of file